@@ -1,10 +1,18 @@
 import streamlit as st
+import asyncio
+import json
+import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from phi.agent import Agent, RunResponse
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from phi.agent import Agent
 from phi.run.response import RunEvent
-from agents import *
-from Constants import *
 
 # ---------------------------------
 # Load ENV
@@ -16,20 +24,74 @@ if not api_key:
     st.error("GROQ_API_KEY not set")
     st.stop()
 
+# Deploy-time switch: verbose agent logging is off unless AGENT_DEBUG=1
+AGENT_DEBUG = os.getenv("AGENT_DEBUG") == "1"
+
 # ---------------------------------
 # Agent Initialization (Cached)
 # ---------------------------------
-@st.cache_resource
-def get_agent() -> Agent:
+# Deploy-time model selection; mirrors the default client in agents.py
+GROQ_MODEL_ID = "moonshotai/kimi-k2-instruct-0905"
+
+# Single source of truth for team membership: build_agent resolves these
+# names lazily from the agents module, and the sidebar derives the size
+_TEAM_MEMBER_NAMES = (
+    "Task_Analyzer",
+    "Incident_Analyzer",
+    "Ticket_Creation",
+    "Root_Cause_Analysis",
+    "resolution_discovery"
+)
+
+TEAM_SIZE = len(_TEAM_MEMBER_NAMES)
+
+def _validate_model(model) -> bool:
+    # Drop the cached client if the deploy-time config changed under it
+    return (model.id == os.getenv("GROQ_MODEL_ID", GROQ_MODEL_ID)
+            and model.api_key == os.getenv("GROQ_API_KEY"))
+
+@st.cache_resource(max_entries=1, ttl=60 * 60, validate=_validate_model)
+def get_model():
+    """Build the configured Groq client once per process.
+
+    Constructed here rather than imported from agents so ttl expiry and
+    the validate check actually rebuild it: re-importing
+    agents.Groq_Clint would always hand back the same module-level
+    object. The cached instance is only a config template — each run
+    works on its own deep copy (see build_agent), because phi registers
+    the run's transfer tools on the model and Model.add_tool skips
+    duplicate names, so a shared model would pin the first run's
+    transfer closures forever.
+    """
+    from phi.model.groq import Groq
+    return Groq(
+        id=os.getenv("GROQ_MODEL_ID", GROQ_MODEL_ID),
+        api_key=os.getenv("GROQ_API_KEY")
+    )
+
+def build_agent() -> Agent:
+    """Build a fresh, lightweight orchestrator Agent for a single run.
+
+    Agent construction is cheap; the orchestrator model is a deep copy
+    of the cached get_model() template, because phi registers the run's
+    transfer_task_to_* closures on the model instance and never replaces
+    an existing name — a shared model would keep delegating through the
+    first run's member agents. The team members are deep-copied for the
+    same reason: phi's transfer functions mutate them per run
+    (session_data, run_response), so the module-level instances must not
+    be shared. Imports of agents/Constants are deferred into this body
+    so their construction side-effects stay off fresh script runs that
+    never submit the form.
+    """
+    import agents
+    from Constants import ITSM_AGENT_SYSTEM_PROMPT
+
     return Agent(
-        model=Groq_Clint,
+        model=get_model().deep_copy(),
         system_prompt=ITSM_AGENT_SYSTEM_PROMPT,
         team=[
-            Task_Analyzer,
-            Incident_Analyzer,
-            Ticket_Creation,
-            Root_Cause_Analysis,
-            resolution_discovery
+            getattr(agents, name).deep_copy()
+            for name in _TEAM_MEMBER_NAMES
         ],
         instructions=[
             "Analyze user input.",
@@ -38,24 +100,247 @@ def get_agent() -> Agent:
             "Return final answer after delegation."
         ],
         markdown=True,
-        show_tool_calls=True,
-        debug_mode=True
+        show_tool_calls=AGENT_DEBUG,
+        debug_mode=AGENT_DEBUG
     )
 
-Sister = get_agent()
+@st.cache_resource
+def get_run_logger() -> logging.Logger:
+    """Process-wide JSONL audit logger for run events.
+
+    A QueueHandler hands records to a QueueListener so the file I/O
+    happens off the streaming thread.
+    """
+    logger = logging.getLogger("itsm.run")
+    if not logger.handlers:
+        log_queue = queue.Queue()
+        file_handler = logging.FileHandler(
+            os.getenv("RUN_LOG_PATH", "itsm_run.jsonl")
+        )
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
 
 # ---------------------------------
 # Helper Functions
 # ---------------------------------
+_AGENT_MAP = {
+    "transfer_task_to_task_analyzer": "📊 Task Analyzer",
+    "transfer_task_to_incident_analyzer": "🔍 Incident Analyzer",
+    "transfer_task_to_ticket_creation": "🎫 Ticket Creation",
+    "transfer_task_to_root_cause_analysis": "🔬 Root Cause Analysis",
+    "transfer_task_to_resolution_discovery": "💡 Resolution Discovery"
+}
+
+_TRANSFER_KEYS = (
+    "task_analyzer",
+    "incident_analyzer",
+    "ticket_creation",
+    "root_cause_analysis",
+    "resolution_discovery"
+)
+
+_AGENT_BY_KEY = {k: _AGENT_MAP[f"transfer_task_to_{k}"] for k in _TRANSFER_KEYS}
+
+# End-of-stream marker for the producer/consumer queue
+_SENTINEL = object()
+
+# Compact execution-step record (cheaper than a per-step dict)
+Step = namedtuple("Step", "icon title content type")
+
+# Static UI text, built once instead of on every rerun
+AGENT_TEAM_MD = """
+    1. 🔍 Incident Analyzer
+    2. 🎫 Ticket Creation
+    3. 🔬 Root Cause Analysis
+    4. 💡 Resolution Discovery
+    """
+
+@st.cache_data(ttl=24 * 60 * 60)
+def get_sidebar_md(team_size: int, debug: bool) -> str:
+    return f"""
+    - Model: Groq
+    - Debug Mode: {"Enabled" if debug else "Disabled"}
+    - Stream Steps: Enabled
+    - Team Size: {team_size}
+    """
+
 def get_agent_name_from_function(function_name: str) -> str:
-    agent_map = {
-        "transfer_task_to_task_analyzer": "📊 Task Analyzer",
-        "transfer_task_to_incident_analyzer": "🔍 Incident Analyzer",
-        "transfer_task_to_ticket_creation": "🎫 Ticket Creation",
-        "transfer_task_to_root_cause_analysis": "🔬 Root Cause Analysis",
-        "transfer_task_to_resolution_discovery": "💡 Resolution Discovery"
-    }
-    return agent_map.get(function_name, "🤖 Agent")
+    return _AGENT_MAP.get(function_name, "🤖 Agent")
+
+# ---------------------------------
+# Event Handlers (dispatch table)
+# ---------------------------------
+@dataclass
+class RunContext:
+    """Mutable per-run state shared by the event handlers."""
+    progress_bar: object
+    status_text: object
+    status: object
+    logger: logging.Logger
+    run_id: str | None = None
+    # Ring buffer for render: memory stays bounded however long the run is
+    execution_steps: deque = field(default_factory=lambda: deque(maxlen=100))
+    # Full completion outputs, flushed to the audit log on run_completed
+    full_outputs: list = field(default_factory=list)
+    step_count: int = 0
+    total_steps: int = 0
+    rendered_count: int = 0
+    current_agent: str | None = None
+    last_progress: float | None = None
+    last_status: str | None = None
+
+def _add_step(ctx, step):
+    """Append a step, keep the render counter, and emit an audit line."""
+    ctx.execution_steps.append(step)
+    ctx.total_steps += 1
+    ctx.logger.info(json.dumps({
+        "ts": time.time(),
+        "run_id": ctx.run_id,
+        "step": ctx.total_steps,
+        "title": step.title,
+        "type": step.type,
+        "content": step.content[:4096]
+    }))
+
+def _on_run_started(response_chunk, ctx):
+    ctx.step_count += 1
+    if ctx.last_progress != 0.1:
+        ctx.progress_bar.progress(0.1)
+        ctx.last_progress = 0.1
+    if ctx.last_status != "🚀 Orchestrator analyzing request":
+        ctx.status_text.info("🚀 Orchestrator analyzing request")
+        ctx.last_status = "🚀 Orchestrator analyzing request"
+
+    _add_step(ctx, Step(
+        "🚀",
+        "Orchestrator Started",
+        "Analyzing incident and determining workflow",
+        "info"
+    ))
+
+def _on_tool_call_started(response_chunk, ctx):
+
+    if not response_chunk.tools:
+        return
+
+    tool_info = response_chunk.tools[-1]
+    function_name = tool_info.get("function_name")
+
+    # Skip internal/system tools
+    if not function_name:
+        return
+
+    if not function_name.startswith("transfer_task_to_"):
+        return
+
+    ctx.current_agent = get_agent_name_from_function(function_name)
+
+    ctx.step_count += 1
+    new_progress = min(ctx.step_count / 10, 0.9)
+    if new_progress != ctx.last_progress:
+        ctx.progress_bar.progress(new_progress)
+        ctx.last_progress = new_progress
+    new_status = f"🔄 Delegating to {ctx.current_agent}"
+    if new_status != ctx.last_status:
+        ctx.status_text.info(new_status)
+        ctx.last_status = new_status
+
+    _add_step(ctx, Step(
+        "🔄",
+        f"Delegating to {ctx.current_agent}",
+        "Task transferred successfully",
+        "delegation"
+    ))
+
+def _on_tool_call_completed(response_chunk, ctx):
+
+    content = response_chunk.content
+    if not content:
+        return
+
+    content_str = str(content)
+
+    # Detect agent from response with a single scan:
+    # locate the prefix once, then prefix-match the short tail
+    detected_agent = None
+    idx = content_str.find("transfer_task_to_")
+    if idx >= 0:
+        tail = content_str[idx + len("transfer_task_to_"):idx + 64]
+        for key in _TRANSFER_KEYS:
+            if tail.startswith(key):
+                detected_agent = _AGENT_BY_KEY[key]
+                break
+
+    agent_name = detected_agent or ctx.current_agent or "🤖 Agent"
+
+    ctx.step_count += 1
+    new_progress = min(ctx.step_count / 10, 0.95)
+    if new_progress != ctx.last_progress:
+        ctx.progress_bar.progress(new_progress)
+        ctx.last_progress = new_progress
+
+    # Keep only a truncated copy in the render record; the full text goes
+    # to full_outputs and is flushed to the audit log on run_completed
+    ctx.full_outputs.append(content_str)
+
+    _add_step(ctx, Step(
+        "✅",
+        f"{agent_name} - Completed",
+        content_str[:4096],
+        "success"
+    ))
+
+    ctx.current_agent = None
+
+def _on_run_completed(response_chunk, ctx):
+    ctx.progress_bar.progress(1.0)
+    ctx.status_text.success("✨ Workflow completed successfully")
+
+    _add_step(ctx, Step(
+        "✨",
+        "Orchestration Completed",
+        "All agents finished successfully",
+        "success"
+    ))
+
+    ctx.status.update(label="✨ Workflow completed", state="complete")
+
+    # Lazy flush of the full (untruncated) completion outputs
+    for i, output in enumerate(ctx.full_outputs, 1):
+        ctx.logger.info(json.dumps({
+            "ts": time.time(),
+            "run_id": ctx.run_id,
+            "completion": i,
+            "content": output
+        }))
+    ctx.full_outputs.clear()
+
+HANDLERS = {
+    RunEvent.run_started.value: _on_run_started,
+    RunEvent.tool_call_started.value: _on_tool_call_started,
+    RunEvent.tool_call_completed.value: _on_tool_call_completed,
+    RunEvent.run_completed.value: _on_run_completed
+}
+
+def render_new_steps(ctx):
+    """Append only the steps added since the last call to the status box.
+
+    Counts against total_steps rather than len() because execution_steps
+    is a bounded deque and old entries fall off the left.
+    """
+    new = ctx.total_steps - ctx.rendered_count
+    if new > 0:
+        for offset in range(new, 0, -1):
+            step = ctx.execution_steps[-offset]
+            num = ctx.total_steps - offset + 1
+            ctx.status.markdown(f"{step.icon} **Step {num}: {step.title}**")
+            if step.content:
+                ctx.status.markdown(step.content)
+        ctx.rendered_count = ctx.total_steps
 
 # ---------------------------------
 # UI Setup
@@ -67,52 +352,54 @@ col1, col2 = st.columns([2, 1])
 
 with col1:
     st.markdown("### 📧 Email Interface")
-    
-    # Email-style input fields
-    email_from = st.text_input(
-        "From:",
-        placeholder="ntid@itsm.com"
-    )
-    email_to = st.text_input(
-        "To:",
-        value="support@itsm.com",
-        placeholder="support@itsm.com"
-    )
-    
-    email_subject = st.text_input(
-        "Subject:",
-        placeholder="Brief description of the incident..."
-    )
-    
-    email_body = st.text_area(
-        "Body:",
-        height=200,
-        placeholder="Describe the incident in detail...\n\nInclude:\n- What happened\n- When it occurred\n- Error messages or logs\n- Impact on users/systems"
-    )
-    
-    # Combine email fields into user_input for processing
-    user_input = f"""reported by {email_from} Subject: {email_subject}
 
-{email_body}"""
+    # Form batches input: the script reruns on submit, not per keystroke
+    with st.form("email_form"):
+        email_from = st.text_input(
+            "From:",
+            placeholder="ntid@itsm.com"
+        )
+        email_to = st.text_input(
+            "To:",
+            value="support@itsm.com",
+            placeholder="support@itsm.com"
+        )
+
+        email_subject = st.text_input(
+            "Subject:",
+            placeholder="Brief description of the incident..."
+        )
+
+        email_body = st.text_area(
+            "Body:",
+            height=200,
+            placeholder="Describe the incident in detail...\n\nInclude:\n- What happened\n- When it occurred\n- Error messages or logs\n- Impact on users/systems"
+        )
+
+        submitted = st.form_submit_button(
+            "🚀 Run Agent",
+            type="primary",
+            use_container_width=True
+        )
 
 with col2:
     st.markdown("### 🤖 Agent Team")
-    st.markdown("""
-    1. 🔍 Incident Analyzer  
-    2. 🎫 Ticket Creation  
-    3. 🔬 Root Cause Analysis  
-    4. 💡 Resolution Discovery  
-    """)
+    st.markdown(AGENT_TEAM_MD)
 
 # ---------------------------------
 # RUN BUTTON
 # ---------------------------------
-if st.button("🚀 Run Agent", type="primary", use_container_width=True):
+if submitted:
 
     if not email_subject.strip() and not email_body.strip():
         st.warning("⚠️ Please enter incident details")
         st.stop()
 
+    # Combine email fields only once the submission is valid
+    user_input = f"""reported by {email_from} Subject: {email_subject}
+
+{email_body}"""
+
     status_container = st.container()
     steps_container = st.container()
     final_container = st.container()
@@ -123,172 +410,127 @@ if st.button("🚀 Run Agent", type="primary", use_container_width=True):
 
     with steps_container:
         st.markdown("## 📋 Execution Steps")
-        steps_placeholder = st.empty()
+        status = st.status("🤖 Running workflow", expanded=True)
 
     try:
-        execution_steps = []
-        step_count = 0
-        current_agent = None
-        full_content = ""
-        run_id = None
-
-        response_stream = Sister.run(
-            user_input,
-            stream=True,
-            stream_intermediate_steps=True
-        )
+        Sister = build_agent()
 
-        for response_chunk in response_stream:
-
-            if not isinstance(response_chunk, RunResponse):
-                continue
-
-            event = response_chunk.event
-            content = response_chunk.content
-            run_id = response_chunk.run_id
-            
-
-            # ---------------------------------
-            # RUN STARTED
-            # ---------------------------------
-            if event == RunEvent.run_started.value:
-                step_count += 1
-                progress_bar.progress(0.1)
-                status_text.info("🚀 Orchestrator analyzing request")
-
-                execution_steps.append({
-                    "icon": "🚀",
-                    "title": "Orchestrator Started",
-                    "content": "Analyzing incident and determining workflow",
-                    "type": "info"
-                })
-
-            # ---------------------------------
-            # TOOL CALL STARTED (Delegation Only)
-            # ---------------------------------
-            elif event == RunEvent.tool_call_started.value:
-
-                if not response_chunk.tools:
-                    continue
-
-                tool_info = response_chunk.tools[-1]
-                function_name = tool_info.get("function_name")
+        ctx = RunContext(
+            progress_bar=progress_bar,
+            status_text=status_text,
+            status=status,
+            logger=get_run_logger()
+        )
 
-                # Skip internal/system tools
-                if not function_name:
-                    continue
+        with final_container:
+            st.markdown("---")
+            st.markdown("## ✅ Final ITSM Report")
 
-                if not function_name.startswith("transfer_task_to_"):
+        # ---------------------------------
+        # Producer Thread (async consumption, keeps the agent off the
+        # script thread without sync-over-async bridging)
+        # ---------------------------------
+        chunk_queue = queue.Queue()
+
+        async def consume_stream():
+            # arun is itself a coroutine that returns the stream
+            # async-generator, so it must be awaited before iterating
+            response_stream = await Sister.arun(
+                user_input,
+                stream=True,
+                stream_intermediate_steps=True
+            )
+            async for response_chunk in response_stream:
+                chunk_queue.put(response_chunk)
+
+        def produce_chunks():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(consume_stream())
+            except Exception as exc:
+                chunk_queue.put(exc)
+            finally:
+                loop.close()
+                chunk_queue.put(_SENTINEL)
+
+        producer = threading.Thread(target=produce_chunks, daemon=True)
+        add_script_run_ctx(producer)
+        producer.start()
+
+        def token_stream():
+            """Yield final-response tokens as they arrive, route step events.
+
+            Drains the producer queue from the main thread so only this
+            thread ever touches Streamlit widgets.
+            """
+            # Bind hot-loop lookups to locals once: LOAD_FAST per chunk
+            # instead of LOAD_GLOBAL + LOAD_ATTR chains
+            get_chunk = chunk_queue.get
+            q_empty = queue.Empty
+            sentinel = _SENTINEL
+            e_response = RunEvent.run_response.value
+            get_handler = HANDLERS.get
+            render = render_new_steps
+
+            while True:
+
+                try:
+                    response_chunk = get_chunk(timeout=0.05)
+                except q_empty:
                     continue
 
-                current_agent = get_agent_name_from_function(function_name)
+                if response_chunk is sentinel:
+                    break
 
-                step_count += 1
-                progress_bar.progress(min(step_count / 10, 0.9))
-                status_text.info(f"🔄 Delegating to {current_agent}")
+                if isinstance(response_chunk, Exception):
+                    raise response_chunk
 
-                execution_steps.append({
-                    "icon": "🔄",
-                    "title": f"Delegating to {current_agent}",
-                    "content": "Task transferred successfully",
-                    "type": "delegation"
-                })
+                # Duck-typed check: phi only yields RunResponse objects here,
+                # so one attribute probe replaces the per-chunk isinstance
+                event = getattr(response_chunk, "event", None)
+                if event is None:
+                    continue
 
-            # ---------------------------------
-            # TOOL CALL COMPLETED
-            # ---------------------------------
-            elif event == RunEvent.tool_call_completed.value:
+                content = response_chunk.content
+                ctx.run_id = response_chunk.run_id
 
-                if not content:
+                # ---------------------------------
+                # FINAL RESPONSE CONTENT
+                # ---------------------------------
+                if event == e_response:
+                    if isinstance(content, str):
+                        yield content
                     continue
 
-                content_str = str(content)
-
-                # Detect agent from response (bulletproof method)
-                detected_agent = None
-                if "transfer_task_to_" in content_str:
-                    for key in [
-                        "task_analyzer",
-                        "incident_analyzer",
-                        "ticket_creation",
-                        "root_cause_analysis",
-                        "resolution_discovery"
-                    ]:
-                        if key in content_str:
-                            detected_agent = get_agent_name_from_function(
-                                f"transfer_task_to_{key}"
-                            )
-                            break
-
-                agent_name = detected_agent or current_agent or "🤖 Agent"
-
-                step_count += 1
-                progress_bar.progress(min(step_count / 10, 0.95))
-
-                execution_steps.append({
-                    "icon": "✅",
-                    "title": f"{agent_name} - Completed",
-                    "content": content_str,
-                    "type": "success"
-                })
-
-                current_agent = None
-
-            # ---------------------------------
-            # FINAL RESPONSE CONTENT
-            # ---------------------------------
-            elif event == RunEvent.run_response.value:
-                if isinstance(content, str):
-                    full_content += content
-
-            # ---------------------------------
-            # RUN COMPLETED
-            # ---------------------------------
-            elif event == RunEvent.run_completed.value:
-                progress_bar.progress(1.0)
-                status_text.success("✨ Workflow completed successfully")
-
-                execution_steps.append({
-                    "icon": "✨",
-                    "title": "Orchestration Completed",
-                    "content": "All agents finished successfully",
-                    "type": "success"
-                })
-
-            # ---------------------------------
-            # Render Steps Live
-            # ---------------------------------
-            with steps_placeholder.container():
-                for idx, step in enumerate(execution_steps, 1):
-                    expanded = step["type"] in ["delegation", "success"]
-
-                    with st.expander(
-                        f"{step['icon']} Step {idx}: {step['title']}",
-                        expanded=expanded
-                    ):
-                        if step["type"] == "info":
-                            st.info(step["content"])
-                        elif step["type"] == "delegation":
-                            st.warning(step["content"])
-                        elif step["type"] == "success":
-                            st.success(step["content"])
-
-        status_container.empty()
+                handler = get_handler(event)
+                if handler:
+                    handler(response_chunk, ctx)
+                    render(ctx)
 
         # ---------------------------------
-        # FINAL REPORT
+        # FINAL REPORT (streamed token by token)
         # ---------------------------------
         with final_container:
-            st.markdown("---")
-            st.markdown("## ✅ Final ITSM Report")
+            full_content = st.write_stream(token_stream())
+
+        # write_stream joins the streamed tokens in one pass; it returns a
+        # list only if non-string chunks slipped through, so normalize once
+        if isinstance(full_content, list):
+            full_content = "".join(str(part) for part in full_content)
 
+        status_container.empty()
+
+        with final_container:
             if full_content:
-                st.markdown(full_content)
+                # Encode once so Streamlit serves the bytes directly instead
+                # of keeping both the str and its encoded copy alive
+                data_bytes = full_content.encode("utf-8")
 
                 st.download_button(
                     label="📥 Download Report",
-                    data=full_content,
-                    file_name=f"itsm_report_{run_id}.md",
+                    data=data_bytes,
+                    file_name=f"itsm_report_{ctx.run_id}.md",
                     mime="text/markdown",
                     use_container_width=True
                 )
@@ -297,6 +539,7 @@ if st.button("🚀 Run Agent", type="primary", use_container_width=True):
 
     except Exception as e:
         status_container.empty()
+        status.update(label="❌ Workflow failed", state="error")
         st.error(f"❌ Error: {str(e)}")
         st.exception(e)
 
@@ -305,9 +548,4 @@ if st.button("🚀 Run Agent", type="primary", use_container_width=True):
 # ---------------------------------
 with st.sidebar:
     st.markdown("## ⚙️ Configuration")
-    st.markdown(f"""
-    - Model: Groq  
-    - Debug Mode: Enabled  
-    - Stream Steps: Enabled  
-    - Team Size: {len(Sister.team)}  
-    """)
\ No newline at end of file
+    st.markdown(get_sidebar_md(TEAM_SIZE, AGENT_DEBUG))
\ No newline at end of file